@@ -3,23 +3,59 @@ import sqlite3
 import json
 import time
 import os
+import threading
+import queue
+import functools
+import atexit
 from datetime import datetime, timedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DB_FILE = "sora_events.db"
 
 
 def init_db():
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
+    # WAL дозволяє читати паралельно із записом, NORMAL прибирає fsync на кожен commit
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA busy_timeout=5000")
     c.execute('''
         CREATE TABLE IF NOT EXISTS events (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp REAL,
+            timestamp INTEGER,
+            day INTEGER,
             event_type TEXT,
             session_id TEXT,
             payload TEXT
         )
     ''')
+    # Міграція старих баз: день (YYYYMMDD, UTC) рахується один раз при вставці
+    columns = {row[1] for row in c.execute("PRAGMA table_info(events)")}
+    if "day" not in columns:
+        c.execute("ALTER TABLE events ADD COLUMN day INTEGER")
+        c.execute(
+            "UPDATE events SET day = CAST(strftime('%Y%m%d', timestamp, 'unixepoch') AS INTEGER) "
+            "WHERE day IS NULL"
+        )
+    # Запити по timestamp замінив idx_events_day; зайві індекси лише сповільнюють вставки
+    c.execute("DROP INDEX IF EXISTS idx_events_ts")
+    c.execute("DROP INDEX IF EXISTS idx_events_type_ts")
+    # Частковий індекс під фільтр get_top_sessions
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_events_session ON events(session_id) "
+        "WHERE event_type IN ('download', 'download_success')"
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_day ON events(day, event_type)")
+    # Повний ANALYZE лише для бази без статистики; далі PRAGMA optimize оновлює її, коли потрібно
+    has_stats = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+    ).fetchone()
+    c.execute("PRAGMA optimize" if has_stats else "ANALYZE")
     conn.commit()
     conn.close()
 
@@ -27,41 +63,176 @@ def init_db():
 # Initialize DB on module import
 init_db()
 
+# Одне з'єднання для запису (під локом) і по одному read-only з'єднанню на потік
+_write_conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+_write_conn.execute("PRAGMA synchronous=NORMAL")
+_write_conn.execute("PRAGMA busy_timeout=5000")
+_write_lock = threading.Lock()
+_read_local = threading.local()
+
+
+def _read_conn():
+    conn = getattr(_read_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
+        conn.execute("PRAGMA busy_timeout=5000")
+        # Читання через mmap (256 MiB) і кеш сторінок ~20 MB на з'єднання
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA cache_size=-20000")
+        _read_local.conn = conn
+    return conn
+
+
+def _encode_payload(payload: dict):
+    # orjson у кілька разів швидший за json.dumps; колонка лишається TEXT
+    if orjson is not None:
+        try:
+            data = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # Цілі поза 64 біт та інші типи, які json.dumps приймає, а orjson - ні
+            data = None
+        # orjson пише NaN/Infinity як null; такі payload кодуємо через json, як і раніше
+        if data is not None and b'null' not in data:
+            return data.decode()
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def _day_of(ts: float):
+    return int(time.strftime('%Y%m%d', time.gmtime(ts)))
+
+
+# Події пишуться фоновим потоком пачками: один commit на пачку замість одного на подію
+BATCH_MAX_SIZE = 500
+BATCH_MAX_WAIT = 0.05
+# Обмежена черга: під навантаженням події відкидаються, а не блокують запит
+QUEUE_MAX_SIZE = 10000
+
+_queue = queue.Queue(maxsize=QUEUE_MAX_SIZE)
+dropped_events = 0
+# Маркер зупинки для потоку запису (див. flush_events)
+_STOP = object()
+
+
+def _write_batch(batch: list):
+    # Ніколи не кидає виняток: інакше потік запису тихо помре, а черга переповниться
+    try:
+        with _write_lock:
+            try:
+                _write_conn.execute("BEGIN")
+                _write_conn.executemany(
+                    "INSERT INTO events (timestamp, day, event_type, session_id, payload) VALUES (?, ?, ?, ?, ?)",
+                    batch
+                )
+                _write_conn.execute("COMMIT")
+            except Exception as e:
+                print(f"Error writing {len(batch)} events: {e}")
+                if _write_conn.in_transaction:
+                    _write_conn.execute("ROLLBACK")
+    except Exception as e:
+        print(f"Error rolling back events batch: {e}")
+
+
+def _drain():
+    stop = False
+    while not stop:
+        batch = []
+        item = _queue.get()
+        while True:
+            if item is _STOP:
+                stop = True
+                break
+            batch.append(item)
+            if len(batch) >= BATCH_MAX_SIZE:
+                break
+            try:
+                item = _queue.get(timeout=BATCH_MAX_WAIT)
+            except queue.Empty:
+                break
+        if batch:
+            _write_batch(batch)
+
+
+_writer = threading.Thread(target=_drain, name="analytics-writer", daemon=True)
+_writer.start()
+
+
+def flush_events(timeout: float = 5.0):
+    """
+    Дописує в базу всі події з черги і зупиняє потік запису.
+    Викликається при завершенні процесу, щоб не втратити вже прийняті події.
+    """
+    try:
+        _queue.put(_STOP, timeout=timeout)
+    except queue.Full:
+        pass
+    _writer.join(timeout)
+    # Якщо потік не встиг (або вже зупинений) - дописуємо залишок синхронно
+    batch = []
+    while True:
+        try:
+            item = _queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not _STOP:
+            batch.append(item)
+    for start in range(0, len(batch), BATCH_MAX_SIZE):
+        _write_batch(batch[start:start + BATCH_MAX_SIZE])
+
+
+atexit.register(flush_events)
+
+
+def enqueue_event(event_type: str, session_id: str, payload: dict):
+    """
+    Ставить подію в чергу запису без блокування. Повертає False, якщо черга повна.
+    """
+    global dropped_events
+    ts = int(time.time())
+    try:
+        _queue.put_nowait((ts, _day_of(ts), event_type, session_id, _encode_payload(payload)))
+        return True
+    except queue.Full:
+        dropped_events += 1
+        # Логуємо першу втрату і далі кожну тисячну, щоб не засмічувати лог під навантаженням
+        if dropped_events % 1000 == 1:
+            print(f"Analytics queue full, dropped {dropped_events} events so far")
+        return False
+
 
 def record_event(event_type: str, session_id: str, payload: dict):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO events (timestamp, event_type, session_id, payload) VALUES (?, ?, ?, ?)",
-        (time.time(), event_type, session_id, json.dumps(payload))
-    )
-    conn.commit()
-    conn.close()
+    if not enqueue_event(event_type, session_id, payload):
+        return "Event dropped: queue full"
     return "Event recorded"
 
 
+# Дашборд опитує статистику часто, а вона змінюється повільно
+STATS_CACHE_TTL = 5
+
+
 def get_stats(days: int = 7):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    cutoff = time.time() - (days * 24 * 60 * 60)
+    # Ключ кешу змінюється раз на STATS_CACHE_TTL секунд - це і є інвалідація
+    return _get_stats_cached(days, int(time.time() // STATS_CACHE_TTL))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_stats_cached(days: int, _ttl_bucket: int):
+    c = _read_conn().cursor()
+    cutoff_day = _day_of(time.time() - (days * 24 * 60 * 60))
 
     query = '''
-        SELECT 
-            date(datetime(timestamp, 'unixepoch')) as day,
-            event_type,
-            COUNT(*) as count
+        SELECT day, event_type, COUNT(*) as count
         FROM events
-        WHERE timestamp > ?
+        WHERE day >= ?
         GROUP BY day, event_type
         ORDER BY day DESC
     '''
 
-    c.execute(query, (cutoff,))
+    c.execute(query, (cutoff_day,))
     rows = c.fetchall()
-    conn.close()
 
     stats = {}
-    for day, ev_type, count in rows:
+    for day_num, ev_type, count in rows:
+        day = f"{day_num // 10000:04d}-{day_num // 100 % 100:02d}-{day_num % 100:02d}"
         if day not in stats:
             stats[day] = {}
         stats[day][ev_type] = count
@@ -73,12 +244,12 @@ def get_top_sessions(limit: int = 5):
     """
     Повертає сесії з найбільшою кількістю скачувань.
     """
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+    c = _read_conn().cursor()
     # Вважаємо, що успішне скачування = подія 'download' або 'download_success'
+    # Фільтр має збігатися з WHERE часткового індексу idx_events_session
     query = '''
         SELECT session_id, COUNT(*) as count
-        FROM events
+        FROM events INDEXED BY idx_events_session
         WHERE event_type IN ('download', 'download_success')
         GROUP BY session_id
         ORDER BY count DESC
@@ -86,6 +257,5 @@ def get_top_sessions(limit: int = 5):
     '''
     c.execute(query, (limit,))
     rows = c.fetchall()
-    conn.close()
 
     return [{"sessionId": row[0], "downloaded": row[1]} for row in rows]
\ No newline at end of file
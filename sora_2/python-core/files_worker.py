@@ -2,6 +2,62 @@
 import os
 import time
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# stat/unlink впираються в латентність ФС, тож потоки масштабуються майже лінійно
+SCAN_WORKERS = 16
+
+# Максимум видалень у черзі executor: пам'ять не залежить від кількості старих файлів
+MAX_PENDING_REMOVALS = SCAN_WORKERS * 4
+
+# Скільки кандидатів показує dry_run; після цього обхід зупиняється
+DRY_RUN_PREVIEW = 10
+
+
+def _scan_dir(path: str):
+    """
+    Сканує одну директорію: повертає (підпапки, файли) і прогріває кеш stat у DirEntry.
+    """
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        entry.stat(follow_symlinks=False)
+                        files.append(entry)
+                except OSError as e:
+                    print(f"Error checking {entry.path}: {e}")
+    except OSError as e:
+        print(f"Error scanning {path}: {e}")
+    return subdirs, files
+
+
+def _scan(root_dir: str, executor: ThreadPoolExecutor):
+    """
+    Обходить дерево паралельно в executor і віддає DirEntry звичайних файлів.
+    """
+    pending = {executor.submit(_scan_dir, root_dir)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            subdirs, files = future.result()
+            for subdir in subdirs:
+                pending.add(executor.submit(_scan_dir, subdir))
+            yield from files
+
+
+def _remove(filepath: str, size: int):
+    try:
+        os.remove(filepath)
+        return size
+    except Exception as e:
+        print(f"Error deleting {filepath}: {e}")
+        return None
 
 
 def cleanup_old_videos(root_dir: str, max_age_days: int, dry_run: bool = False):
@@ -10,56 +66,71 @@ def cleanup_old_videos(root_dir: str, max_age_days: int, dry_run: bool = False):
 
     now = time.time()
     cutoff = now - (max_age_days * 24 * 60 * 60)
-    deleted_count = 0
-    reclaimed_bytes = 0
+    # Лічильники замість списків: пам'ять не росте разом із деревом
+    totals = {"deleted_count": 0, "reclaimed_bytes": 0}
+    totals_lock = threading.Lock()
+    removal_slots = threading.BoundedSemaphore(MAX_PENDING_REMOVALS)
+
+    skipped_preview = []
+    truncated = False
 
-    skipped = []
-    deleted = []
+    def on_removed(future):
+        removal_slots.release()
+        size = future.result()
+        if size is not None:
+            with totals_lock:
+                totals["deleted_count"] += 1
+                totals["reclaimed_bytes"] += size
 
-    for root, dirs, files in os.walk(root_dir):
-        for name in files:
-            if not name.endswith(".mp4"):
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        for entry in _scan(root_dir, executor):
+            if not entry.name.endswith(".mp4"):
                 continue
 
-            filepath = os.path.join(root, name)
-            try:
-                stat = os.stat(filepath)
-                if stat.st_mtime < cutoff:
-                    size = stat.st_size
-                    if not dry_run:
-                        os.remove(filepath)
-                        deleted.append(filepath)
-                        deleted_count += 1
-                        reclaimed_bytes += size
-                    else:
-                        skipped.append(filepath)
-            except Exception as e:
-                print(f"Error checking {filepath}: {e}")
-
-    mb_reclaimed = round(reclaimed_bytes / (1024 * 1024), 2)
+            stat = entry.stat(follow_symlinks=False)
+            if stat.st_mtime < cutoff:
+                if not dry_run:
+                    removal_slots.acquire()
+                    executor.submit(_remove, entry.path, stat.st_size).add_done_callback(on_removed)
+                else:
+                    skipped_preview.append(entry.path)
+                    if len(skipped_preview) >= DRY_RUN_PREVIEW:
+                        # Для прев'ю решта дерева не потрібна
+                        truncated = True
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        break
+
+    mb_reclaimed = round(totals["reclaimed_bytes"] / (1024 * 1024), 2)
 
     if dry_run:
         return {
             "status": "dry_run",
-            "would_delete": len(skipped),
-            "files": skipped[:10]  # Показати перші 10
+            # При обрізаному прев'ю повна кількість невідома - не вигадуємо її
+            "would_delete": None if truncated else len(skipped_preview),
+            "truncated": truncated,
+            "files": skipped_preview
         }
 
     return {
         "status": "success",
-        "deleted_count": deleted_count,
+        "deleted_count": totals["deleted_count"],
         "reclaimed_mb": mb_reclaimed
     }
 
 
+def iter_empty_files(root_dir: str):
+    """
+    Ліниво віддає шляхи порожніх файлів; можна зупинитись раніше (itertools.islice).
+    """
+    executor = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    try:
+        for entry in _scan(root_dir, executor):
+            if entry.stat(follow_symlinks=False).st_size == 0:
+                yield entry.path
+    finally:
+        # Якщо споживач зупинився, решту запланованих сканувань скасовуємо
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def find_empty_files(root_dir: str):
-    empty = []
-    for root, dirs, files in os.walk(root_dir):
-        for name in files:
-            filepath = os.path.join(root, name)
-            try:
-                if os.path.getsize(filepath) == 0:
-                    empty.append(filepath)
-            except:
-                pass
-    return empty
\ No newline at end of file
+    return list(iter_empty_files(root_dir))
\ No newline at end of file
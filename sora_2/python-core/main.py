@@ -79,16 +79,17 @@ def run_qa_check(payload: PathPayload):
 
 # --- Analytics Routes ---
 @app.post("/analytics/record")
-def api_record_event(payload: EventPayload):
+async def api_record_event(payload: EventPayload):
+    # enqueue_event не блокує, тож обробник виконується прямо в event loop без threadpool
     try:
-        res = analytics_worker.record_event(payload.event_type, payload.session_id, payload.payload)
-        return {"ok": True, "details": res}
+        queued = analytics_worker.enqueue_event(payload.event_type, payload.session_id, payload.payload)
+        return {"ok": True, "details": "Event recorded" if queued else "Event dropped: queue full"}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 @app.get("/analytics/stats")
 def api_get_stats(days: int = 7):
-    return {"ok": True, "stats": analytics_worker.get_stats(days)}
+    return {"ok": True, "stats": analytics_worker.get_stats(days), "dropped": analytics_worker.dropped_events}
 
 @app.get("/analytics/top-sessions")
 def api_get_top_sessions(limit: int = 5):
@@ -1,17 +1,43 @@
 # Path: python-core/notify_worker.py
-import requests
+import threading
+
+# Keep-alive сесія на кожен потік: TLS-рукостискання з api.telegram.org лише на першому повідомленні.
+# requests не гарантує потокобезпечність Session, а /notify/send виконується в threadpool
+_local = threading.local()
+
+
+def _get_session():
+    session = getattr(_local, "session", None)
+    if session is None:
+        # requests тягне ssl/urllib3 (~80 мс) - імпортуємо лише коли справді надсилаємо
+        import requests
+        session = _local.session = requests.Session()
+    return session
+
+
+def _reset_session():
+    session = getattr(_local, "session", None)
+    if session is not None:
+        _local.session = None
+        session.close()
 
 
 def send_telegram_msg(token: str, chat_id: str, text: str):
     if not token or not chat_id:
         return "Skipped: credentials missing"
 
+    import requests
+
     url = f"https://api.telegram.org/bot{token}/sendMessage"
+    session = _get_session()
     try:
-        resp = requests.post(url, json={"chat_id": chat_id, "text": text}, timeout=10)
+        resp = session.post(url, json={"chat_id": chat_id, "text": text}, timeout=10)
         resp.raise_for_status()
         return "Message sent"
     except Exception as e:
+        # Після мережевої помилки з'єднання може бути зламане - наступний виклик відкриє нове
+        if not isinstance(e, requests.HTTPError):
+            _reset_session()
         return f"Error sending message: {str(e)}"
 
 
@@ -2,25 +2,333 @@
 import os
 import ffmpeg
 import json
-from glob import glob
+import shutil
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from functools import partial, lru_cache
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl FICLONE: миттєвий reflink на btrfs/xfs
+FICLONE = 0x40049409
+
+
+@lru_cache(maxsize=None)
+def _load_av():
+    # PyAV імпортується при першому використанні, а не на старті сервера (~50 мс)
+    try:
+        import av
+    except ImportError:
+        return None
+    return av
 
 
 def ensure_dir(path: str):
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
+
+
+def _list_mp4(input_dir: str):
+    """
+    mp4 файли в папці (без підпапок і прихованих файлів, як glob("*.mp4")).
+    Один прохід scandir замість glob/fnmatch.
+    """
+    try:
+        with os.scandir(input_dir) as it:
+            return [
+                entry.path for entry in it
+                if entry.name.endswith(".mp4") and not entry.name.startswith(".") and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
+
+# З stderr ffmpeg зберігаємо лише хвіст: помилка завжди в останніх рядках
+FFMPEG_STDERR_TAIL_LINES = 64
+FFMPEG_STDERR_LINE_MAX = 4096
+
+
+def _feed_stdin(stdin, data: bytes):
+    # Якщо ffmpeg завершився раніше, pipe закритий - справжню помилку кине _run_ffmpeg
+    try:
+        stdin.write(data)
+    except OSError:
+        pass
+    try:
+        stdin.close()
+    except OSError:
+        pass
+
+
+def _run_ffmpeg(stream_spec, input: bytes = None):
+    """
+    Аналог .run(quiet=True), але stderr читається потоково в обмежений буфер,
+    тож пам'ять не залежить від багатослівності ffmpeg.
+    При помилці кидає ffmpeg.Error з останніми рядками stderr.
+    """
+    process = ffmpeg.run_async(stream_spec, pipe_stdin=input is not None, pipe_stderr=True)
+    if input is not None:
+        threading.Thread(target=_feed_stdin, args=(process.stdin, input), daemon=True).start()
+
+    tail = deque(maxlen=FFMPEG_STDERR_TAIL_LINES)
+    pending = b''
+    for chunk in iter(partial(process.stderr.read, 65536), b''):
+        # Прогрес ffmpeg розділяє \r, тож ріжемо і по ньому
+        lines = (pending + chunk).replace(b'\r', b'\n').split(b'\n')
+        pending = lines.pop()[-FFMPEG_STDERR_LINE_MAX:]
+        tail.extend(line for line in lines if line)
+    if pending:
+        tail.append(pending)
+
+    if process.wait() != 0:
+        raise ffmpeg.Error('ffmpeg', None, b'\n'.join(tail))
+
+
+def _unlink_quiet(path: str):
+    # Один syscall без гонки exists()/remove(); відсутній файл - не помилка
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _fast_copy(src: str, dst: str):
+    """
+    Копіює файл без проходу байтів через Python:
+    reflink (FICLONE) -> copy_file_range -> shutil.copyfile (sendfile/fcopyfile).
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copied = False
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                copied = True
+            except OSError:
+                pass
+        if not copied and hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if sent == 0:
+                        break
+                    remaining -= sent
+                copied = remaining == 0
+            except OSError:
+                pass
+    if not copied:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+# Кожен libx264 отримує кілька потоків, а файли кодуються паралельно окремими процесами ffmpeg
+THREADS_PER_ENCODE = 2
+
+# veryfast ~2x швидший за fast при майже непомітній різниці для видалення водяного знаку;
+# для пакетної переобробки можна передати preset='ultrafast' і tune='zerolatency'
+DEFAULT_X264_PRESET = 'veryfast'
+DEFAULT_X264_CRF = 20
+
+QA_PROBE_WORKERS = 8
+
+# Апаратне кодування: FFMPEG_HWACCEL=cuda (NVENC) або vaapi; інакше libx264
+HWACCEL = os.environ.get('FFMPEG_HWACCEL', '').lower()
+if HWACCEL not in ('cuda', 'vaapi'):
+    HWACCEL = ''
+VAAPI_DEVICE = os.environ.get('FFMPEG_VAAPI_DEVICE', '/dev/dri/renderD128')
+# Споживчі драйвери NVIDIA обмежують кількість одночасних сесій NVENC
+HW_MAX_PARALLEL = 2
+
+
+def _normalize_zones(zones: list):
+    """
+    Перетворює зони з config на кортежі (x, y, w, h) і відкидає невалідні.
+    Виконується один раз на process_blur, а не для кожного файлу.
+    """
+    normalized = []
+    for zone in zones or []:
+        x, y = int(zone.get('x', 0)), int(zone.get('y', 0))
+        w, h = int(zone.get('width', 0)), int(zone.get('height', 0))
+
+        # Перевірка валідності зони
+        if w > 0 and h > 0:
+            normalized.append((x, y, w, h))
+    return normalized
+
+
+def _build_zone_chain(video, zones: list):
+    """
+    Додає delogo для кожної зони (з _normalize_zones) в один ланцюжок фільтрів,
+    щоб усі зони оброблялися за одне кодування.
+    Повертає (вузол відео, чи був доданий хоча б один фільтр).
+    """
+    for x, y, w, h in zones:
+        # delogo - ефективний фільтр для видалення водяних знаків
+        video = ffmpeg.filter(video, 'delogo', x=x, y=y, w=w, h=h, show=0)
+    return video, bool(zones)
+
+
+def _hw_input_args(accel: str):
+    if accel == 'cuda':
+        return {'hwaccel': 'cuda'}
+    if accel == 'vaapi':
+        return {'hwaccel': 'vaapi', 'vaapi_device': VAAPI_DEVICE}
+    return {}
+
+
+def _x264_opts(config: dict, threads: int):
+    """
+    Параметри libx264 з config: preset, crf, а також необов'язкові tune і x264opts.
+    """
+    config = config or {}
+    opts = {
+        'preset': config.get('preset') or DEFAULT_X264_PRESET,
+        'crf': int(config.get('crf', DEFAULT_X264_CRF)),
+        'threads': threads,
+    }
+    if config.get('tune'):
+        opts['tune'] = config['tune']
+    if config.get('x264opts'):
+        opts['x264opts'] = config['x264opts']
+    return opts
+
+
+def _encode_args(accel: str, x264_opts: dict):
+    if accel == 'cuda':
+        return {'vcodec': 'h264_nvenc', 'preset': 'p4', 'rc': 'vbr', 'cq': 23}
+    if accel == 'vaapi':
+        return {'vcodec': 'h264_vaapi', 'qp': 23}
+    return {'vcodec': 'libx264', **x264_opts}
+
+
+def _probe_encoder(accel: str):
+    """
+    Перевіряє апаратний енкодер одним кадром nullsrc -> null.
+    Повертає accel, якщо він працює, інакше '' (libx264).
+    """
+    if not accel:
+        return ''
+    video = ffmpeg.input('nullsrc=s=256x256', format='lavfi', **_hw_input_args(accel)).video
+    if accel == 'vaapi':
+        video = video.filter('format', 'nv12').filter('hwupload')
+    try:
+        _run_ffmpeg(ffmpeg.output(video, '-', format='null', vframes=1, **_encode_args(accel, {})))
+        return accel
+    except ffmpeg.Error as e:
+        error_msg = e.stderr.decode('utf8') if e.stderr else str(e)
+        print(f"Hardware encoder ({accel}) unavailable, using libx264: {error_msg}")
+        return ''
+
 
+def _encode_blur(file_path: str, output_path: str, zones: list, x264_opts: dict, accel: str):
+    """
+    Обробляє один файл (ffmpeg або копія). Кидає ffmpeg.Error чи OSError при помилці.
+    """
+    # Починаємо ланцюжок фільтрів
+    stream = ffmpeg.input(file_path, **_hw_input_args(accel))
+    video, has_filters = _build_zone_chain(stream.video, zones)
+
+    if has_filters:
+        # Перекодування потрібне для застосування фільтрів.
+        # delogo працює на CPU, тож для VAAPI кадри вивантажуються на GPU вже після нього
+        if accel == 'vaapi':
+            video = video.filter('format', 'nv12').filter('hwupload')
+        # Розширення .part ffmpeg не розпізнає, тож формат задаємо явно
+        out = ffmpeg.output(video, stream.audio, output_path, format='mp4', acodec='copy',
+                            **_encode_args(accel, x264_opts))
+        _run_ffmpeg(out.overwrite_output())
+    else:
+        # Якщо зон немає, файл просто копіюється ядром, без запуску ffmpeg
+        _fast_copy(file_path, output_path)
+
+
+def _blur_one(file_path: str, output_dir: str, zones: list, x264_opts: dict = None, accel: str = ''):
+    """
+    Обробляє один файл для process_blur (zones - результат _normalize_zones,
+    accel - енкодер, вже перевірений _probe_encoder).
+    Повертає True при успіху.
+    """
+    filename = os.path.basename(file_path)
+    output_path = os.path.join(output_dir, filename)
+    # Пишемо в .part і атомарно перейменовуємо: обірване кодування не лишить битий mp4
+    part_path = output_path + '.part'
+    x264_opts = x264_opts or _x264_opts(None, THREADS_PER_ENCODE)
+
+    # Енкодер може бути справним, але без вільної сесії - тоді файл перекодовується на libx264
+    for attempt_accel in ([accel, ''] if accel else ['']):
+        try:
+            _encode_blur(file_path, part_path, zones, x264_opts, attempt_accel)
+            os.replace(part_path, output_path)
+            return True
+        except ffmpeg.Error as e:
+            # Логуємо помилку, але не зупиняємо весь процес
+            error_msg = e.stderr.decode('utf8') if e.stderr else str(e)
+            if attempt_accel:
+                print(f"Hardware encode ({attempt_accel}) failed for {filename}, retrying with libx264: {error_msg}")
+            else:
+                print(f"Error blurring {filename}: {error_msg}")
+        except OSError as e:
+            print(f"Error copying {filename}: {e}")
+            break
+    _unlink_quiet(part_path)
+    return False
+
+
+def _probe_duration(path: str):
+    """
+    Тривалість відео для QA або None, якщо файл не читається чи немає відео потоку.
+    Результат кешується за (шлях, mtime, розмір), тож повторні перевірки не відкривають файл.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return _probe_duration_cached(path, st.st_mtime_ns, st.st_size)
 
-def get_video_info(path: str):
+
+@lru_cache(maxsize=512)
+def _probe_duration_cached(path: str, _mtime_ns: int, _size: int):
+    if _load_av() is not None:
+        return _probe_duration_av(path)
+    return _probe_duration_ffprobe(path)
+
+
+def _probe_duration_av(path: str):
+    av = _load_av()
+    # PyAV читає заголовки в процесі, без запуску ffprobe
     try:
-        probe = ffmpeg.probe(path)
-        video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
-        format_info = probe['format']
-        # Повертаємо комбіновану інформацію
-        if video_stream:
-            return {**video_stream, 'duration': format_info.get('duration', 0)}
+        with av.open(path) as container:
+            if not container.streams.video:
+                return None
+            if container.duration is None:
+                return 0.0
+            return float(container.duration) / av.time_base
+    except Exception:
         return None
-    except ffmpeg.Error:
+
+
+def _probe_duration_ffprobe(path: str):
+    # Легкий ffprobe: лише тривалість і типи потоків
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration:stream=codec_type',
+        '-of', 'json', path
+    ]
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0:
+        return None
+    try:
+        probe = json.loads(result.stdout)
+    except ValueError:
+        return None
+    if not any(stream.get('codec_type') == 'video' for stream in probe.get('streams', [])):
         return None
+    return float(probe.get('format', {}).get('duration', 0))
 
 
 def process_blur(input_dir: str, output_dir: str, config: dict = None):
@@ -28,109 +336,153 @@ def process_blur(input_dir: str, output_dir: str, config: dict = None):
     Блюрить відео, застосовуючи зони з config['zones'].
     Використовує фільтр 'delogo' для ефективного видалення водяних знаків.
     Format zones: [{ "x": 10, "y": 10, "width": 100, "height": 50 }, ...]
+    Файли обробляються паралельно (config['parallel'] одночасних ffmpeg).
+    З апаратним енкодером одночасних кодувань не більше config['hw_parallel'] (2).
+    Якість/швидкість libx264: config['preset'] (за замовчуванням veryfast), config['crf'] (20),
+    config['tune'], config['x264opts'].
     """
     if not output_dir:
         raise ValueError("Output dir required for blur")
 
     ensure_dir(output_dir)
-    files = glob(os.path.join(input_dir, "*.mp4"))
+    files = sorted(_list_mp4(input_dir))
     zones = config.get('zones', []) if config else []
     processed_count = 0
 
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        output_path = os.path.join(output_dir, filename)
+    if files:
+        valid_zones = _normalize_zones(zones)
+        # Апаратний енкодер перевіряється один раз, а не падінням на кожному файлі
+        accel = _probe_encoder(HWACCEL) if valid_zones else ''
+        default_workers = max(1, (os.cpu_count() or 1) // THREADS_PER_ENCODE)
+        workers = int(config.get('parallel', default_workers)) if config else default_workers
+        if accel:
+            hw_workers = int(config.get('hw_parallel', HW_MAX_PARALLEL)) if config else HW_MAX_PARALLEL
+            workers = min(workers, hw_workers)
+        workers = max(1, min(workers, len(files)))
+        # Ядра ділимо між паралельними кодуваннями, щоб libx264 не конкурували за CPU
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        x264_opts = _x264_opts(config, threads)
+        # Уся робота - в дочірньому ffmpeg або копіюванні ядром, тож потоків достатньо;
+        # процеси перезапускали б імпорт main.py (init_db, потік аналітики) у кожному воркері
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(partial(_blur_one, output_dir=output_dir, zones=valid_zones, x264_opts=x264_opts, accel=accel), files)
+            processed_count = sum(1 for ok in results if ok)
 
-        try:
-            # Починаємо ланцюжок фільтрів
-            stream = ffmpeg.input(file_path)
-            video = stream.video
-            audio = stream.audio
-
-            has_filters = False
-            if zones:
-                for zone in zones:
-                    x, y = int(zone.get('x', 0)), int(zone.get('y', 0))
-                    w, h = int(zone.get('width', 0)), int(zone.get('height', 0))
-
-                    # Перевірка валідності зони
-                    if w > 0 and h > 0:
-                        # delogo - ефективний фільтр для видалення водяних знаків
-                        video = ffmpeg.filter(video, 'delogo', x=x, y=y, w=w, h=h, show=0)
-                        has_filters = True
-
-            if has_filters:
-                # Перекодування потрібне для застосування фільтрів
-                # crf=23 - стандартна якість, preset=fast - баланс швидкості
-                out = ffmpeg.output(video, audio, output_path, c_v='libx264', preset='fast', crf=23, c_a='copy')
-            else:
-                # Якщо зон немає, просто копіюємо потоки (миттєво)
-                out = ffmpeg.output(stream, output_path, c='copy')
+    return f"Blurred {processed_count} videos with {len(zones)} zones"
 
-            out.overwrite_output().run(quiet=True)
-            processed_count += 1
 
-        except ffmpeg.Error as e:
-            # Логуємо помилку, але не зупиняємо весь процес
-            error_msg = e.stderr.decode('utf8') if e.stderr else str(e)
-            print(f"Error blurring {filename}: {error_msg}")
-            continue
+def _merge_av(files: list, output_file: str):
+    """
+    Склеює файли ремуксом у процесі через PyAV, без запуску ffmpeg.
+    Як і concat demuxer, очікує однаковий набір потоків у всіх файлах.
+    Кожен файл зсувається на сумарну тривалість попередніх.
+    """
+    av = _load_av()
+    with av.open(output_file, 'w') as output:
+        out_streams = None
+        offset = Fraction(0)
+        last_dts = {}
+        for file_path in files:
+            with av.open(file_path) as container:
+                in_streams = [st for st in container.streams if st.type in ('video', 'audio')]
+                if out_streams is None:
+                    out_streams = [output.add_stream_from_template(st) for st in in_streams]
+                elif [st.type for st in in_streams] != [st.type for st in out_streams]:
+                    raise ValueError(f"Stream layout differs in {os.path.basename(file_path)}")
+                if container.duration is None:
+                    raise ValueError(f"Unknown duration of {os.path.basename(file_path)}")
 
-    return f"Blurred {processed_count} videos with {len(zones)} zones"
+                start = Fraction(container.start_time or 0, av.time_base)
+                stream_map = {st.index: out for st, out in zip(in_streams, out_streams)}
+                for packet in container.demux(in_streams):
+                    # Порожній пакет у кінці потоку - сигнал flush, його не пишемо
+                    if packet.dts is None:
+                        continue
+                    shift = int((offset - start) / packet.time_base)
+                    dts = packet.dts + shift
+                    pts = packet.pts + shift if packet.pts is not None else None
+                    # Хвіст аудіо може заходити за тривалість файлу - DTS має строго зростати
+                    out_stream = stream_map[packet.stream.index]
+                    prev = last_dts.get(out_stream.index)
+                    if prev is not None and dts * packet.time_base <= prev:
+                        dts = int(prev / packet.time_base) + 1
+                        if pts is not None and pts < dts:
+                            pts = dts
+                    last_dts[out_stream.index] = dts * packet.time_base
+                    packet.dts = dts
+                    packet.pts = pts
+                    packet.stream = out_stream
+                    output.mux(packet)
+
+                offset += Fraction(container.duration, av.time_base)
+
+
+def _merge_ffmpeg(files: list, output_file: str):
+    # Список для concat demuxer передається через stdin, без тимчасового файлу.
+    # Шляхи мають бути абсолютні і з префіксом file:, інакше ffmpeg рахує їх від pipe:
+    lines = []
+    for file_path in files:
+        # Екранування для ffmpeg concat demuxer
+        safe_path = os.path.abspath(file_path).replace("'", "'\\''")
+        lines.append(f"file 'file:{safe_path}'\n")
+    list_bytes = "".join(lines).encode('utf-8')
+
+    _run_ffmpeg(
+        ffmpeg
+        .input('pipe:0', format='concat', safe=0, protocol_whitelist='pipe,file')
+        .output(output_file, c='copy')
+        .overwrite_output(),
+        input=list_bytes
+    )
 
 
 def process_merge(input_dir: str, output_file: str, mode: str):
     """
     Об'єднує всі mp4 файли з папки в один.
+    Спершу пробує ремукс через PyAV, за потреби - ffmpeg concat demuxer.
     """
-    files = sorted(glob(os.path.join(input_dir, "*.mp4")))
+    files = sorted(_list_mp4(input_dir))
     if not files:
         return "No files to merge"
 
     ensure_dir(os.path.dirname(output_file))
 
-    list_path = os.path.join(input_dir, "merge_list.txt")
-    try:
-        with open(list_path, 'w', encoding='utf-8') as f:
-            for file_path in files:
-                # Екранування для ffmpeg concat demuxer
-                safe_path = file_path.replace("'", "'\\''")
-                f.write(f"file '{safe_path}'\n")
+    if _load_av() is not None:
+        try:
+            _merge_av(files, output_file)
+            return f"Merged {len(files)} videos to {os.path.basename(output_file)}"
+        except Exception as e:
+            print(f"PyAV merge failed, falling back to ffmpeg: {e}")
 
-        (
-            ffmpeg
-            .input(list_path, format='concat', safe=0)
-            .output(output_file, c='copy')
-            .overwrite_output()
-            .run(quiet=True)
-        )
+    try:
+        _merge_ffmpeg(files, output_file)
         return f"Merged {len(files)} videos to {os.path.basename(output_file)}"
     except ffmpeg.Error as e:
         error_msg = e.stderr.decode('utf8') if e.stderr else str(e)
         raise RuntimeError(f"Merge failed: {error_msg}")
-    finally:
-        if os.path.exists(list_path):
-            os.remove(list_path)
+
+
+def _clean_one(file_path: str):
+    temp_path = file_path + ".tmp.mp4"
+    try:
+        _run_ffmpeg(
+            ffmpeg
+            .input(file_path)
+            .output(temp_path, map_metadata=-1, c='copy')
+            .overwrite_output()
+        )
+        os.replace(temp_path, file_path)
+        return True
+    except Exception:
+        _unlink_quiet(temp_path)
+        return False
 
 
 def process_clean_metadata(input_dir: str):
-    files = glob(os.path.join(input_dir, "*.mp4"))
-    count = 0
-    for file_path in files:
-        temp_path = file_path + ".tmp.mp4"
-        try:
-            (
-                ffmpeg
-                .input(file_path)
-                .output(temp_path, map_metadata=-1, c='copy')
-                .overwrite_output()
-                .run(quiet=True)
-            )
-            os.replace(temp_path, file_path)
-            count += 1
-        except Exception:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+    files = _list_mp4(input_dir)
+    # Ремукс з c=copy майже не вантажить CPU, тож запускаємо кілька ffmpeg одночасно
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        count = sum(1 for ok in executor.map(_clean_one, files) if ok)
 
     return f"Cleaned metadata for {count} videos"
 
@@ -138,23 +490,25 @@ def process_clean_metadata(input_dir: str):
 def process_qa_check(input_dir: str):
     """
     Перевіряє відео на валідність:
-    1. Чи читається файл (ffprobe)
+    1. Чи читається файл (PyAV або ffprobe)
     2. Чи є відео потік
     3. Чи тривалість > 1 секунди
     """
-    files = glob(os.path.join(input_dir, "*.mp4"))
+    files = _list_mp4(input_dir)
     report = {"total": len(files), "passed": 0, "failed": [], "details": []}
 
-    for file_path in files:
+    # PyAV відпускає GIL під час читання заголовків (а ffprobe - окремий процес), тож потоки масштабуються
+    with ThreadPoolExecutor(max_workers=QA_PROBE_WORKERS) as executor:
+        durations = list(executor.map(_probe_duration, files))
+
+    for file_path, duration in zip(files, durations):
         filename = os.path.basename(file_path)
-        info = get_video_info(file_path)
 
-        if not info:
+        if duration is None:
             report["failed"].append(filename)
             report["details"].append({"file": filename, "reason": "Corrupted or invalid format"})
             continue
 
-        duration = float(info.get('duration', 0))
         if duration < 1.0:
             report["failed"].append(filename)
             report["details"].append({"file": filename, "reason": f"Too short ({duration}s)"})